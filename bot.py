@@ -1,31 +1,72 @@
 import asyncio
+import contextlib
+import functools
+import hmac
+import io
+import itertools
+import logging
 import os
 import re
+import signal
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
 import aiosqlite
+import orjson
+from aiohttp import web
 from dotenv import load_dotenv
 from telegram import (
     InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup,
-    KeyboardButton, Update, LabeledPrice, InputFile
+    KeyboardButton, Update, LabeledPrice, MessageOriginChannel
 )
 from telegram.constants import ParseMode, ChatType
 from telegram.ext import (
     ApplicationBuilder, Application, CommandHandler, ContextTypes,
     MessageHandler, CallbackQueryHandler, filters, PreCheckoutQueryHandler,
-    ConversationHandler
+    AIORateLimiter
 )
+from telegram.request import HTTPXRequest
+
+log = logging.getLogger(__name__)
 
 # ================== ENV / CONST ==================
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+ADMIN_CHAT_ID_INT: Optional[int] = (
+    int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID and ADMIN_CHAT_ID.lstrip("-").isdigit() else None
+)
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN")  # optional
 MANAGER_USERNAME = os.getenv("MANAGER_USERNAME", "Granku56")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "")  # без @, для deep-link
 
+# Webhook включается, если задан WEBHOOK_URL (https://host без пути); иначе — polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or os.getenv("PORT") or 8443)  # PORT выдаёт Render
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "")  # по умолчанию /<BOT_TOKEN>
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+
+# Типы апдейтов, на которые есть хендлеры; остальные Telegram отфильтрует у себя
+ALLOWED_UPDATES = [
+    Update.MESSAGE, Update.CHANNEL_POST, Update.CALLBACK_QUERY, Update.PRE_CHECKOUT_QUERY,
+]
+POLL_TIMEOUT = 50  # секунд long-poll в getUpdates
+# С платежами очередь при старте разбирает replay_pending_payments, сбрасывать её нельзя
+DROP_PENDING_UPDATES = not PAYMENT_PROVIDER_TOKEN
+
+# Исходящие вызовы Bot API идут через свой пул keep-alive соединений по HTTP/2,
+# getUpdates — через отдельное соединение, чтобы long-poll не занимал пул хендлеров
+HTTP_POOL_SIZE = 64
+HTTP_POOL_TIMEOUT = 5
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 20
+# Лимиты Telegram: ~30 сообщений/с на бота, 20/мин на группу; 429 повторяем сами
+RATE_LIMIT_PER_SEC = 28
+RATE_LIMIT_RETRIES = 3
+
 DB_PATH = "store.db"
 
 BTN_CART = "🛒 Корзина"
@@ -34,9 +75,41 @@ BTN_ORDERS = "🧾 Мои покупки"
 BTN_FEEDBACK = "✉️ Обратная связь"
 BTN_BACK_TO_CATS = "⬅️ Назад в категории"
 
-IMPORT_WAIT_FILE = 1001
+IMPORT_BATCH_SIZE = 1000  # строк CSV на одну транзакцию
+CHANNEL_QUEUE_SIZE = 10_000  # постов из канала в очереди на запись
+CHANNEL_BATCH_MAX = 500      # постов на одну транзакцию
+CHANNEL_LINGER = 0.5         # секунд добираем пачку после первого поста
+# Пул потоков по умолчанию для asyncio.to_thread (aiosqlite держит свой поток)
+THREAD_POOL_SIZE = min(32, (os.cpu_count() or 1) * 4)
+
+# Фильтры собираются один раз; первым идёт самый дешёвый и избирательный (тип чата)
+PRIVATE_TEXT = filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND & ~filters.FORWARDED
+PRIVATE_FORWARD_MEDIA = filters.ChatType.PRIVATE & filters.FORWARDED & (filters.PHOTO | filters.TEXT)
+CHANNEL_MEDIA = filters.ChatType.CHANNEL & (filters.PHOTO | filters.TEXT)
+PRIVATE_DOCUMENT = filters.ChatType.PRIVATE & filters.Document.ALL
 
 # ========= HELPERS =========
+# Подписи приходят из чужих каналов, поэтому длину разбираемого текста ограничиваем
+# максимумом сообщения Telegram: все шаблоны ниже с ограниченными повторами и на
+# 4096 символах укладываются в миллисекунды. re2 не подходит: \b и \w в нём только
+# ASCII — перестают находиться «500 руб» и хэштеги на кириллице.
+PARSE_MAX_CHARS = 4096
+
+_PRICE_RE1 = re.compile(r"(?:цена[:\s]*)?(\d[\d\s\.]{1,12})\s?(?:₽|руб|руб\.|р)\b", re.IGNORECASE)
+_PRICE_RE2 = re.compile(r"\b(\d[\d\s\.]{1,12})\s?(?:₽|руб|руб\.|р)\b", re.IGNORECASE)
+_NONDIGIT_RE = re.compile(r"[^\d]")
+_SIZES_RE = re.compile(r"(?:размеры?|sizes?)\s*[:\-–]\s*([A-Za-zА-Яа-я0-9 ,\/\-]+)", re.IGNORECASE)
+# Строка целиком из размеров. [^\S\n] — пробельный символ, кроме перевода строки,
+# чтобы совпадение не перескакивало на соседние строки
+_SIZES_STANDALONE = re.compile(
+    r"^[^\S\n]*((?:[A-Za-zА-Яа-я0-9]{1,3}(?:[,\/\-]|[^\S\n])+){1,10}[A-Za-zА-Яа-я0-9]{1,3})[^\S\n]*$",
+    re.MULTILINE
+)
+_WS_RE = re.compile(r"\s+")
+_HASHTAG_RE = re.compile(r"#([\w\d_]+)", re.UNICODE)
+
+# Цены в каталоге повторяются от карточки к карточке — кэшируем готовые строки
+@functools.lru_cache(maxsize=1024)
 def price_fmt(p: int) -> str:
     rub, kop = p // 100, p % 100
     return f"{rub:,}.{kop:02d} ₽".replace(",", " ")
@@ -44,41 +117,39 @@ def price_fmt(p: int) -> str:
 def parse_price(text: str) -> Optional[int]:
     if not text:
         return None
-    t = text.replace("\u00a0", " ")
-    patterns = [
-        r"(?:цена[:\s]*)?(\d[\d\s\.]{1,12})\s?(?:₽|руб|руб\.|р)\b",
-        r"\b(\d[\d\s\.]{1,12})\s?(?:₽|руб|руб\.|р)\b",
-    ]
-    for pat in patterns:
-        m = re.search(pat, t, flags=re.IGNORECASE)
+    t = text[:PARSE_MAX_CHARS].replace("\u00a0", " ")
+    for pat in (_PRICE_RE1, _PRICE_RE2):
+        m = pat.search(t)
         if m:
-            num = re.sub(r"[^\d]", "", m.group(1))
+            num = _NONDIGIT_RE.sub("", m.group(1))
             if num.isdigit():
                 return int(num) * 100
+    # строка целиком из цифр/пробелов/точек: 2–13 символов, начинается с цифры.
+    # Большинство строк отсекается на len/первом символе, без входа в regex
     for line in t.splitlines():
-        if re.fullmatch(r"\s*\d[\d\s\.]{1,12}\s*", line.strip()):
-            num = re.sub(r"[^\d]", "", line)
-            if num.isdigit():
-                return int(num) * 100
+        s = line.strip()
+        if 2 <= len(s) <= 13 and s[0].isdecimal() and all(c.isdecimal() or c == "." or c.isspace() for c in s):
+            return int("".join(filter(str.isdecimal, s))) * 100
     return None
 
 def parse_sizes(text: str) -> Optional[str]:
     if not text:
         return None
-    t = text.replace("\u00a0", " ")
-    m = re.search(r"(?:размеры?|sizes?)\s*[:\-–]\s*([A-Za-zА-Яа-я0-9 ,\/\-]+)", t, flags=re.IGNORECASE)
+    t = text[:PARSE_MAX_CHARS].replace("\u00a0", " ")
+    m = _SIZES_RE.search(t)
     if m:
-        sizes = re.sub(r"\s+", " ", m.group(1).strip())
+        sizes = _WS_RE.sub(" ", m.group(1).strip())
         return sizes[:120]
-    for line in t.splitlines():
-        if re.fullmatch(r"\s*(?:[A-Za-zА-Яа-я0-9]{1,3}[\s,\/\-]+){1,10}[A-Za-zА-Яа-я0-9]{1,3}\s*", line.strip()):
-            return line.strip()[:120]
+    # splitlines() режет и по \r, \x0b, \u2028 и т.п. — приводим к \n для ^/$ в MULTILINE
+    m = _SIZES_STANDALONE.search("\n".join(t.splitlines()))
+    if m:
+        return m.group(1)[:120]
     return None
 
 def parse_hashtags(text: str) -> List[str]:
     if not text:
         return []
-    tags = re.findall(r"#([\w\d_]+)", text, flags=re.UNICODE)
+    tags = _HASHTAG_RE.findall(text[:PARSE_MAX_CHARS])
     return [t.strip() for t in tags if t.strip()]
 
 def first_line(text: str) -> str:
@@ -100,9 +171,23 @@ class Product:
     source_msg_id: Optional[int]
 
 # ========= DB INIT =========
-INIT_SQL = """
-PRAGMA journal_mode=WAL;
+# page_size меняется только вне WAL и вступает в силу после VACUUM
+DB_PAGE_SIZE = 4096
+# Кэш подготовленных выражений sqlite3 (по тексту SQL) на общем соединении:
+# ~20 фиксированных запросов + до 32 вариантов list_products, с запасом
+DB_CACHED_STATEMENTS = 256
+
+# Настройки соединения (не хранятся в файле БД, применяются при каждом открытии)
+PRAGMAS_SQL = """
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+PRAGMA busy_timeout=60000;
+PRAGMA foreign_keys=ON;
+"""
 
+INIT_SQL = """
 CREATE TABLE IF NOT EXISTS products(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     title TEXT NOT NULL,
@@ -117,6 +202,10 @@ CREATE TABLE IF NOT EXISTS products(
 );
 
 CREATE UNIQUE INDEX IF NOT EXISTS idx_source_msg ON products(source_chat_id, source_msg_id);
+-- rowid неявно лежит в конце ключа, поэтому страница бренда ищется по индексу
+-- и идёт в порядке ORDER BY id DESC без временного B-дерева (остальные колонки
+-- читаются из таблицы по rowid); SELECT DISTINCT category/brand индекс покрывает
+CREATE INDEX IF NOT EXISTS idx_products_cat_brand ON products(category, brand);
 
 CREATE TABLE IF NOT EXISTS cart(
     user_id INTEGER NOT NULL,
@@ -147,141 +236,298 @@ CREATE TABLE IF NOT EXISTS order_items(
 );
 """
 
+# Одно долгоживущее соединение на весь процесс: открывается в init_db(),
+# закрывается в close_db(). Запись сериализуем через DB_WRITE_LOCK, чтобы
+# commit одного хендлера не попадал в середину транзакции другого.
+DB: Optional[aiosqlite.Connection] = None
+DB_WRITE_LOCK = asyncio.Lock()
+
+# Все записи идут через db_write(): лок, commit при успехе, rollback при ошибке
+# (и при отмене задачи) — иначе незакрытую неявную транзакцию на общем
+# соединении закоммитит следующий писатель
+@contextlib.asynccontextmanager
+async def db_write():
+    global _CATALOG_GEN
+    async with DB_WRITE_LOCK:
+        try:
+            yield
+        except BaseException:
+            _CATALOG_GEN += 1  # откат мог убрать строки, которые уже прочли читатели каталога
+            await DB.rollback()
+            raise
+        await DB.commit()
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(INIT_SQL)
-        await db.commit()
+    global DB
+    DB = await aiosqlite.connect(DB_PATH, cached_statements=DB_CACHED_STATEMENTS)
+    async with DB.execute("PRAGMA page_size") as cur:
+        (page_size,) = await cur.fetchone()
+    if page_size != DB_PAGE_SIZE:
+        await DB.execute("PRAGMA journal_mode=DELETE")
+        await DB.execute(f"PRAGMA page_size={DB_PAGE_SIZE}")
+        await DB.execute("VACUUM")
+    await DB.execute("PRAGMA journal_mode=WAL")
+    await DB.executescript(PRAGMAS_SQL)
+    await DB.executescript(INIT_SQL)
+    # полный ANALYZE — только на новой базе; дальше статистику освежает optimize
+    async with DB.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'") as cur:
+        has_stats = await cur.fetchone() is not None
+    await DB.execute("PRAGMA optimize" if has_stats else "ANALYZE")
+    await DB.commit()
+
+async def close_db():
+    global DB
+    if DB is not None:
+        await DB.close()
+        DB = None
 
 # ========= DB QUERIES =========
+# Кэш категорий и брендов: on_text дёргает их на каждое сообщение, а меняются
+# они только когда add_product вставляет товар с новой категорией/брендом
+# Списки — для клавиатур (в порядке ORDER BY), frozenset — для проверки «это кнопка?»
+_CAT_CACHE: Optional[List[str]] = None
+_CAT_SET: FrozenSet[str] = frozenset()
+_BRAND_CACHE: Dict[str, List[str]] = {}
+_BRAND_SETS: Dict[str, FrozenSet[str]] = {}
+# При холодном кэше параллельные апдейты ждут один SELECT, а не шлют каждый свой
+_CATALOG_LOCK = asyncio.Lock()
+# Поколение каталога растёт при каждой записи товаров и каждом откате. Читатель
+# кладёт результат в кэш, только если поколение за время SELECT не сменилось и
+# открытой транзакции нет: читатели ходят через то же соединение, что и писатели,
+# и иначе могли видеть каталог до вставки или ещё не закоммиченные строки.
+_CATALOG_GEN = 0
+
+def invalidate_catalog_cache(category: str, brand: str):
+    global _CAT_CACHE, _CATALOG_GEN
+    _CATALOG_GEN += 1
+    if _CAT_CACHE is not None and category not in _CAT_SET:
+        _CAT_CACHE = None
+    brands = _BRAND_SETS.get(category)
+    if brands is not None and brand not in brands:
+        del _BRAND_CACHE[category], _BRAND_SETS[category]
+
+INSERT_PRODUCT_SQL = """
+    INSERT OR IGNORE INTO products
+    (title, price, photo_file_id, descr, category, brand, sizes, source_chat_id, source_msg_id)
+    VALUES(?,?,?,?,?,?,?,?,?)
+"""
+
+# Повторная пересылка того же поста (тот же источник) ничего не пишет: id ищем
+# по источнику заранее — SQLite занимает AUTOINCREMENT ещё до проверки конфликта,
+# даже при DO NOTHING.
+UPSERT_PRODUCT_SQL = """
+    INSERT INTO products
+    (title, price, photo_file_id, descr, category, brand, sizes, source_chat_id, source_msg_id)
+    VALUES(?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(source_chat_id, source_msg_id) DO NOTHING
+    RETURNING id
+"""
+PRODUCT_ID_BY_SOURCE_SQL = "SELECT id FROM products WHERE source_chat_id=? AND source_msg_id=?"
+
+def product_row(p: Product) -> Tuple:
+    return (p.title, p.price, p.photo_file_id, p.descr, p.category, p.brand, p.sizes, p.source_chat_id, p.source_msg_id)
+
 async def add_product(p: Product) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            INSERT OR IGNORE INTO products
-            (title, price, photo_file_id, descr, category, brand, sizes, source_chat_id, source_msg_id)
-            VALUES(?,?,?,?,?,?,?,?,?)
-        """, (p.title, p.price, p.photo_file_id, p.descr, p.category, p.brand, p.sizes, p.source_chat_id, p.source_msg_id))
-        await db.commit()
-        if cur.lastrowid:
-            return cur.lastrowid
-        cur2 = await db.execute("""
-            SELECT id FROM products WHERE source_chat_id IS ? AND source_msg_id IS ?
-        """, (p.source_chat_id, p.source_msg_id))
-        row = await cur2.fetchone()
-        return row[0] if row else 0
+    return (await upsert_products([p]))[0]
+
+# Несколько товаров одной транзакцией; id возвращаются в том же порядке
+async def upsert_products(products: List[Product]) -> List[int]:
+    ids = []
+    async with db_write():
+        for p in products:
+            row = None
+            if p.source_chat_id is not None and p.source_msg_id is not None:
+                cur = await DB.execute(PRODUCT_ID_BY_SOURCE_SQL, (p.source_chat_id, p.source_msg_id))
+                row = await cur.fetchone()
+            if row is None:
+                cur = await DB.execute(UPSERT_PRODUCT_SQL, product_row(p))
+                row = await cur.fetchone()
+            ids.append(row[0])
+    for category, brand in {(p.category, p.brand) for p in products}:
+        invalidate_catalog_cache(category, brand)
+    return ids
+
+# Пачка одной executemany и одним commit; возвращает число реально вставленных строк
+async def add_products_bulk(products: List[Product]) -> int:
+    if not products:
+        return 0
+    async with db_write():
+        cur = await DB.executemany(INSERT_PRODUCT_SQL, [product_row(p) for p in products])
+    if cur.rowcount:
+        for category, brand in {(p.category, p.brand) for p in products}:
+            invalidate_catalog_cache(category, brand)
+    return cur.rowcount
 
 async def get_categories() -> List[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT DISTINCT category FROM products ORDER BY category")
-        rows = await cur.fetchall()
-    return [r[0] for r in rows if r[0]]
+    global _CAT_CACHE, _CAT_SET
+    if _CAT_CACHE is None:
+        async with _CATALOG_LOCK:
+            if _CAT_CACHE is None:
+                gen = _CATALOG_GEN
+                cur = await DB.execute("SELECT DISTINCT category FROM products ORDER BY category")
+                cats = [r[0] for r in await cur.fetchall() if r[0]]
+                if gen != _CATALOG_GEN or DB.in_transaction:
+                    return cats
+                _CAT_SET = frozenset(cats)
+                _CAT_CACHE = cats
+    return _CAT_CACHE
 
 async def get_brands_by_category(category: str) -> List[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT DISTINCT brand FROM products WHERE category=? ORDER BY brand", (category,))
-        rows = await cur.fetchall()
-    return [r[0] for r in rows if r[0]]
+    brands = _BRAND_CACHE.get(category)
+    if brands is None:
+        async with _CATALOG_LOCK:
+            brands = _BRAND_CACHE.get(category)
+            if brands is None:
+                gen = _CATALOG_GEN
+                cur = await DB.execute("SELECT DISTINCT brand FROM products WHERE category=? ORDER BY brand",
+                                       (category,))
+                brands = [r[0] for r in await cur.fetchall() if r[0]]
+                if gen == _CATALOG_GEN and not DB.in_transaction:
+                    _BRAND_SETS[category] = frozenset(brands)
+                    _BRAND_CACHE[category] = brands
+    return brands
+
+async def is_category(name: str) -> bool:
+    if _CAT_CACHE is None:
+        return name in await get_categories()
+    return name in _CAT_SET
+
+async def is_brand(category: str, name: str) -> bool:
+    brands = _BRAND_SETS.get(category)
+    if brands is None:
+        return name in await get_brands_by_category(category)
+    return name in brands
+
+# Все 2^5 вариантов WHERE собраны заранее: один и тот же текст SQL на каждую
+# комбинацию фильтров — без склейки строк и с попаданием в кэш выражений sqlite3
+_LIST_FILTERS = ("category=?", "brand=?", "price>=?", "price<=?", "sizes LIKE ?")
+
+def _list_products_sql(mask: Tuple[bool, ...]) -> str:
+    q = "SELECT id,title,price,photo_file_id,descr,category,brand,sizes,source_chat_id,source_msg_id FROM products"
+    where = [cond for cond, on in zip(_LIST_FILTERS, mask) if on]
+    if where:
+        q += " WHERE " + " AND ".join(where)
+    return q + " ORDER BY id DESC LIMIT ? OFFSET ?"
+
+LIST_PRODUCTS_SQL: Dict[Tuple[bool, ...], str] = {
+    mask: _list_products_sql(mask) for mask in itertools.product((False, True), repeat=len(_LIST_FILTERS))
+}
 
 async def list_products(category: Optional[str]=None, brand: Optional[str]=None,
                         price_from: Optional[int]=None, price_to: Optional[int]=None,
                         size_query: Optional[str]=None,
                         offset: int=0, limit: int=6) -> List[Product]:
-    q = "SELECT id,title,price,photo_file_id,descr,category,brand,sizes,source_chat_id,source_msg_id FROM products"
-    params: Tuple = ()
-    where = []
-    if category:
-        where.append("category=?"); params += (category,)
-    if brand:
-        where.append("brand=?"); params += (brand,)
-    if price_from is not None:
-        where.append("price>=?"); params += (price_from,)
-    if price_to is not None:
-        where.append("price<=?"); params += (price_to,)
-    if size_query:
-        where.append("sizes LIKE ?"); params += (f"%{size_query}%",)
-    if where:
-        q += " WHERE " + " AND ".join(where)
-    q += " ORDER BY id DESC LIMIT ? OFFSET ?"
-    params += (limit, offset)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(q, params)
-        rows = await cur.fetchall()
+    mask = (bool(category), bool(brand), price_from is not None, price_to is not None, bool(size_query))
+    values = (category, brand, price_from, price_to, f"%{size_query}%" if size_query else None)
+    params = tuple(v for v, on in zip(values, mask) if on) + (limit, offset)
+    cur = await DB.execute(LIST_PRODUCTS_SQL[mask], params)
+    rows = await cur.fetchall()
     return [Product(*r) for r in rows]
 
 async def get_product_by_id(pid: int) -> Optional[Product]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT id,title,price,photo_file_id,descr,category,brand,sizes,source_chat_id,source_msg_id
-            FROM products WHERE id=?
-        """, (pid,))
-        row = await cur.fetchone()
+    cur = await DB.execute("""
+        SELECT id,title,price,photo_file_id,descr,category,brand,sizes,source_chat_id,source_msg_id
+        FROM products WHERE id=?
+    """, (pid,))
+    row = await cur.fetchone()
     return Product(*row) if row else None
 
 async def get_cart(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT p.id, p.title, p.price, c.qty
-            FROM cart c JOIN products p ON p.id=c.product_id
-            WHERE c.user_id=?
-        """, (user_id,))
-        return await cur.fetchall()
+    cur = await DB.execute("""
+        SELECT p.id, p.title, p.price, c.qty
+        FROM cart c JOIN products p ON p.id=c.product_id
+        WHERE c.user_id=?
+    """, (user_id,))
+    return await cur.fetchall()
+
+# None — корзина пуста (в отличие от корзины из товаров с нулевой ценой)
+async def cart_total(user_id: int) -> Optional[int]:
+    cur = await DB.execute("""
+        SELECT SUM(p.price * c.qty)
+        FROM cart c JOIN products p ON p.id=c.product_id
+        WHERE c.user_id=?
+    """, (user_id,))
+    (total,) = await cur.fetchone()
+    return total
 
 async def add_to_cart(user_id: int, product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    async with db_write():
+        await DB.execute("""
             INSERT INTO cart(user_id, product_id, qty)
             VALUES(?,?,1)
             ON CONFLICT(user_id, product_id) DO UPDATE SET qty=qty+1
         """, (user_id, product_id))
-        await db.commit()
 
 async def clear_cart(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
-        await db.commit()
+    async with db_write():
+        await DB.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
 
 async def add_to_wardrobe(user_id: int, product_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO wardrobe(user_id, product_id) VALUES(?,?)", (user_id, product_id))
-        await db.commit()
+    async with db_write():
+        await DB.execute("INSERT OR IGNORE INTO wardrobe(user_id, product_id) VALUES(?,?)", (user_id, product_id))
 
 async def get_wardrobe(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT p.id, p.title, p.price
-            FROM wardrobe w JOIN products p ON p.id=w.product_id
-            WHERE w.user_id=?
-        """, (user_id,))
-        return await cur.fetchall()
+    cur = await DB.execute("""
+        SELECT p.id, p.title, p.price
+        FROM wardrobe w JOIN products p ON p.id=w.product_id
+        WHERE w.user_id=?
+    """, (user_id,))
+    return await cur.fetchall()
 
 async def create_order(user_id: int):
-    items = await get_cart(user_id)
-    if not items:
-        return None
-    total = sum(price * qty for _, _, price, qty in items)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "INSERT INTO orders(user_id, total_price, status) VALUES(?,?, 'NEW')",
-            (user_id, total)
-        )
-        order_id = cur.lastrowid
-        await db.executemany(
-            "INSERT INTO order_items(order_id, product_id, qty, price) VALUES(?,?,?,?)",
-            [(order_id, pid, qty, price) for (pid, _, price, qty) in items]
-        )
-        await db.commit()
-    await clear_cart(user_id)
+    # Чтение корзины, заказ, позиции и очистка корзины — одна транзакция
+    async with db_write():
+        await DB.execute("BEGIN IMMEDIATE")
+        # сумму считает SQLite; на пустой корзине GROUP BY не даёт ни одной строки
+        # (HAVING без GROUP BY SQLite принимает только с 3.39)
+        cur = await DB.execute("""
+            INSERT INTO orders(user_id, total_price, status)
+            SELECT ?, SUM(p.price * c.qty), 'NEW'
+            FROM cart c JOIN products p ON p.id=c.product_id
+            WHERE c.user_id=?
+            GROUP BY c.user_id
+            RETURNING id, total_price
+        """, (user_id, user_id))
+        row = await cur.fetchone()
+        if row is None:
+            return None  # пустая транзакция, commit ничего не пишет
+        order_id, total = row
+        await DB.execute("""
+            INSERT INTO order_items(order_id, product_id, qty, price)
+            SELECT ?, p.id, c.qty, p.price
+            FROM cart c JOIN products p ON p.id=c.product_id
+            WHERE c.user_id=?
+        """, (order_id, user_id))
+        await DB.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
     return order_id, total
 
 async def list_orders(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT id, total_price, status, created_at
-            FROM orders WHERE user_id=? ORDER BY id DESC
-        """, (user_id,))
-        return await cur.fetchall()
+    cur = await DB.execute("""
+        SELECT id, total_price, status, created_at
+        FROM orders WHERE user_id=? ORDER BY id DESC
+    """, (user_id,))
+    return await cur.fetchall()
 
 # ========= KEYBOARDS =========
+# Разметка в PTB неизменяема после создания, поэтому готовые клавиатуры можно
+# переиспользовать между сообщениями. Категории/бренды меняются редко (см. кэш
+# каталога), карточки зависят только от pid и констант окружения.
+MENU_ROWS = (
+    (KeyboardButton(BTN_CART), KeyboardButton(BTN_WARDROBE)),
+    (KeyboardButton(BTN_ORDERS), KeyboardButton(BTN_FEEDBACK)),
+)
+BACK_TO_CATS_ROW = (KeyboardButton(BTN_BACK_TO_CATS),)
+CART_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Оплатить", callback_data="checkout_pay")] if PAYMENT_PROVIDER_TOKEN
+    else [InlineKeyboardButton("✅ Оформить заказ", callback_data="checkout")],
+    [InlineKeyboardButton("🗑 Очистить корзину", callback_data="clearcart")],
+])
+
 def build_categories_kb(categories: List[str]) -> ReplyKeyboardMarkup:
+    return _categories_kb(tuple(categories))
+
+@functools.lru_cache(maxsize=32)
+def _categories_kb(categories: Tuple[str, ...]) -> ReplyKeyboardMarkup:
     if not categories:
         categories = ["🧥 Куртки", "👕 Одежда", "👖 Джинсы", "👟 Кроссовки"]
     rows = []
@@ -290,13 +536,14 @@ def build_categories_kb(categories: List[str]) -> ReplyKeyboardMarkup:
         if i + 1 < len(categories):
             row.append(KeyboardButton(categories[i+1]))
         rows.append(row)
-    rows += [
-        [KeyboardButton(BTN_CART), KeyboardButton(BTN_WARDROBE)],
-        [KeyboardButton(BTN_ORDERS), KeyboardButton(BTN_FEEDBACK)]
-    ]
+    rows += MENU_ROWS
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
 def build_brands_kb(brands: List[str]) -> ReplyKeyboardMarkup:
+    return _brands_kb(tuple(brands))
+
+@functools.lru_cache(maxsize=256)
+def _brands_kb(brands: Tuple[str, ...]) -> ReplyKeyboardMarkup:
     if not brands:
         brands = ["NoBrand"]
     rows = []
@@ -305,9 +552,10 @@ def build_brands_kb(brands: List[str]) -> ReplyKeyboardMarkup:
         if i + 1 < len(brands):
             row.append(KeyboardButton(brands[i+1]))
         rows.append(row)
-    rows.append([KeyboardButton(BTN_BACK_TO_CATS)])
+    rows.append(BACK_TO_CATS_ROW)
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
+@functools.lru_cache(maxsize=4096)
 def product_inline_kb(pid: int) -> InlineKeyboardMarkup:
     dl = f"https://t.me/{BOT_USERNAME}?start=prd_{pid}" if BOT_USERNAME else None
     rows = [
@@ -322,6 +570,28 @@ def product_inline_kb(pid: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 # ========= VIEWS =========
+def per_chat(handler):
+    """Обновления одного чата обрабатываются по очереди, разных чатов — параллельно."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if context.chat_data is None:
+            return await handler(update, context)
+        lock = context.chat_data.setdefault("lock", asyncio.Lock())
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
+async def notify_admin(bot, text: str):
+    if ADMIN_CHAT_ID_INT is not None:
+        await bot.send_message(ADMIN_CHAT_ID_INT, text)
+
+# Независимые отправки — параллельно; сбой одной (бот заблокирован, флуд-лимит)
+# не отменяет остальные и не обрывает хендлер, а только пишется в лог
+async def send_all(*sends):
+    for res in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(res, Exception):
+            log.error("Не удалось отправить сообщение", exc_info=res)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     if args and len(args) >= 1 and args[0].startswith("prd_"):
@@ -354,7 +624,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Выберите категорию:",
             reply_markup=build_categories_kb(cats)
         )
-    if not ADMIN_CHAT_ID and update.message:
+    if ADMIN_CHAT_ID_INT is None and update.message:
         await update.message.reply_text("ℹ️ Укажи ADMIN_CHAT_ID в переменных окружения, чтобы получать обратную связь.")
 
 async def show_products_by_brand(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str, brand: str,
@@ -397,15 +667,9 @@ async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for pid, title, price, qty in rows:
         lines.append(f"• {title} × {qty} = {price_fmt(price*qty)}")
         total += price * qty
-    buttons = [[InlineKeyboardButton("🗑 Очистить корзину", callback_data="clearcart")]]
-    if PAYMENT_PROVIDER_TOKEN:
-        buttons.insert(0, [InlineKeyboardButton("✅ Оплатить", callback_data="checkout_pay")])
-    else:
-        buttons.insert(0, [InlineKeyboardButton("✅ Оформить заказ", callback_data="checkout")])
-    kb = InlineKeyboardMarkup(buttons)
     await update.message.reply_text(
         "Корзина:\n" + "\n".join(lines) + f"\n\nИтого: *{price_fmt(total)}*",
-        parse_mode=ParseMode.MARKDOWN, reply_markup=kb
+        parse_mode=ParseMode.MARKDOWN, reply_markup=CART_KB
     )
 
 async def show_wardrobe(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -431,6 +695,7 @@ async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Ваши покупки:\n" + "\n".join(parts))
 
 # ========= CALLBACKS =========
+@per_chat
 async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
@@ -458,22 +723,23 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.message.reply_text("Корзина пуста.")
             return
         order_id, total = res
-        await q.message.reply_text(
-            f"Заказ #{order_id} оформлен на сумму {price_fmt(total)} ✅\n"
-            f"Статус: NEW. Мы свяжемся с вами для оплаты/доставки."
-        )
-        if ADMIN_CHAT_ID:
-            await context.bot.send_message(
-                int(ADMIN_CHAT_ID),
+        # ответ покупателю и уведомление админу независимы — отправляем параллельно
+        await send_all(
+            q.message.reply_text(
+                f"Заказ #{order_id} оформлен на сумму {price_fmt(total)} ✅\n"
+                f"Статус: NEW. Мы свяжемся с вами для оплаты/доставки."
+            ),
+            notify_admin(
+                context.bot,
                 f"Новый заказ #{order_id} от @{q.from_user.username or q.from_user.id} на сумму {price_fmt(total)}"
-            )
+            ),
+        )
 
     elif data == "checkout_pay":
-        rows = await get_cart(q.from_user.id)
-        if not rows:
+        total = await cart_total(q.from_user.id)
+        if total is None:
             await q.message.reply_text("Корзина пуста.")
             return
-        total = sum(price * qty for _, _, price, qty in rows)
         await context.bot.send_invoice(
             chat_id=q.message.chat_id,
             title="Оплата заказа",
@@ -489,6 +755,7 @@ async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.message.reply_text("Корзина очищена.")
 
 # ========= TEXT ROUTER =========
+@per_chat
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
         return
@@ -496,10 +763,11 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # режим обратной связи
     if context.user_data.get("awaiting_feedback"):
         msg = update.message.text
-        await update.message.reply_text("Спасибо! Передал админу.")
-        if ADMIN_CHAT_ID:
-            u = update.effective_user
-            await context.bot.send_message(int(ADMIN_CHAT_ID), f"Обратная связь от @{u.username or u.id}:\n\n{msg}")
+        u = update.effective_user
+        await send_all(
+            update.message.reply_text("Спасибо! Передал админу."),
+            notify_admin(context.bot, f"Обратная связь от @{u.username or u.id}:\n\n{msg}"),
+        )
         context.user_data["awaiting_feedback"] = False
         return
 
@@ -515,10 +783,6 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["awaiting_feedback"] = True
         await update.message.reply_text("Напишите сообщение. Отмена — /cancel")
         return
-    if txt == "/cancel":
-        context.user_data["awaiting_feedback"] = False
-        await update.message.reply_text("Отменено.")
-        return
 
     if txt == BTN_BACK_TO_CATS:
         context.user_data.pop("selected_category", None)
@@ -547,14 +811,14 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Фильтры очищены.")
         return
 
-    cats = await get_categories()
-    if txt in cats:
+    # сюда доходят только кнопки категорий/брендов — сверяем по закэшированным множествам
+    if await is_category(txt):
         context.user_data["selected_category"] = txt
         brands = await get_brands_by_category(txt)
         if not brands:
             return await update.message.reply_text(
                 "В этой категории пока нет брендов.",
-                reply_markup=build_categories_kb(cats)
+                reply_markup=build_categories_kb(await get_categories())
             )
         return await update.message.reply_text(
             f"Категория {txt}. Выберите бренд:",
@@ -562,23 +826,32 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     sel_cat = context.user_data.get("selected_category")
-    if sel_cat:
-        brands = await get_brands_by_category(sel_cat)
-        if txt in brands:
-            pf = context.user_data.get("price_from")
-            pt = context.user_data.get("price_to")
-            sz = context.user_data.get("size_query")
-            return await show_products_by_brand(
-                update, context, category=sel_cat, brand=txt, offset=0,
-                price_from=pf, price_to=pt, size_query=sz
-            )
+    if sel_cat and await is_brand(sel_cat, txt):
+        pf = context.user_data.get("price_from")
+        pt = context.user_data.get("price_to")
+        sz = context.user_data.get("size_query")
+        return await show_products_by_brand(
+            update, context, category=sel_cat, brand=txt, offset=0,
+            price_from=pf, price_to=pt, size_query=sz
+        )
 
     return await start(update, context)
 
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop("awaiting_feedback", None)
+    context.user_data.pop("awaiting_import", None)
+    await update.message.reply_text("Отменено.")
+
 # ========= IMPORT ИЗ ПЕРЕСЫЛКИ =========
+# Хендлер только проверяет апдейт и отдаёт разбор и запись фоновой задаче;
+# application.create_task логирует её ошибки и дожидается её при остановке
 async def import_from_forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
         return
+    context.application.create_task(_process_forward(update, context), update=update)
+
+@per_chat
+async def _process_forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     caption = msg.caption or msg.text or ""
     tags = parse_hashtags(caption)
@@ -588,8 +861,10 @@ async def import_from_forward(update: Update, context: ContextTypes.DEFAULT_TYPE
     price = parse_price(caption)
     sizes = parse_sizes(caption)
     photo_file_id = msg.photo[-1].file_id if msg.photo else None
-    source_chat_id = msg.forward_from_chat.id if msg.forward_from_chat else None
-    source_msg_id = msg.forward_from_message_id if msg.forward_from_message_id else None
+    origin = msg.forward_origin
+    is_channel = isinstance(origin, MessageOriginChannel)
+    source_chat_id = origin.chat.id if is_channel else None
+    source_msg_id = origin.message_id if is_channel else None
 
     p = Product(0, title, price or 0, photo_file_id, caption, category, brand, sizes, source_chat_id, source_msg_id)
     pid = await add_product(p)
@@ -602,6 +877,10 @@ async def import_from_forward(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
 # ========= АВТОИМПОРТ ИЗ КАНАЛА =========
+# Хендлер только парсит пост и кладёт товар в очередь; пишет фоновая задача
+# пачками по одной транзакции. None в очереди — сигнал остановки.
+CHANNEL_QUEUE: "asyncio.Queue[Optional[Product]]" = asyncio.Queue(maxsize=CHANNEL_QUEUE_SIZE)
+
 async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.channel_post
     if not msg:
@@ -618,57 +897,126 @@ async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo_file_id = msg.photo[-1].file_id if msg.photo else None
 
     p = Product(0, title, price, photo_file_id, caption, category, brand, sizes, msg.chat_id, msg.message_id)
-    pid = await add_product(p)
-    if ADMIN_CHAT_ID:
-        await context.bot.send_message(int(ADMIN_CHAT_ID), f"Импортирован пост из канала как товар id={pid} ({category}/{brand}).")
+    await CHANNEL_QUEUE.put(p)  # при переполнении ждём, а не теряем пост
+
+async def channel_import_worker(bot):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await CHANNEL_QUEUE.get()]
+        # посты при пересылке пачкой приходят с разрывом в десятки мс — ждём их
+        # немного, чтобы записать одной транзакцией; сигнал остановки не ждёт
+        deadline = loop.time() + CHANNEL_LINGER
+        while len(batch) < CHANNEL_BATCH_MAX and batch[-1] is not None:
+            if not CHANNEL_QUEUE.empty():
+                batch.append(CHANNEL_QUEUE.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(CHANNEL_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        products = [p for p in batch if p is not None]
+        if products:
+            await store_channel_posts(bot, products)
+        if None in batch:
+            return
+
+# Пачка пишется одной транзакцией; если она упала (SQLITE_BUSY, битая строка),
+# повторяем по одному посту, чтобы из-за одного не потерять всю пачку
+async def store_channel_posts(bot, products: List[Product]):
+    failed = 0
+    try:
+        ids = await upsert_products(products)
+    except Exception:
+        log.exception("Пачка из %d пост(ов) канала не записалась, пишем по одному", len(products))
+        stored, ids = [], []
+        for p in products:
+            try:
+                ids.append(await add_product(p))
+            except Exception:
+                log.exception("Не удалось записать пост %s/%s из канала", p.source_chat_id, p.source_msg_id)
+                failed += 1
+            else:
+                stored.append(p)
+        products = stored
+    await notify_channel_import(bot, products, ids, failed)
+
+async def notify_channel_import(bot, products: List[Product], ids: List[int], failed: int = 0):
+    lines = []
+    if len(ids) == 1:
+        p = products[0]
+        lines.append(f"Импортирован пост из канала как товар id={ids[0]} ({p.category}/{p.brand}).")
+    elif ids:
+        lines.append(f"Импортировано постов из канала: {len(ids)} (id {min(ids)}–{max(ids)}).")
+    if failed:
+        lines.append(f"⚠️ Не удалось записать постов из канала: {failed} (подробности в логе).")
+    try:
+        await notify_admin(bot, "\n".join(lines))
+    except Exception:
+        log.exception("Не удалось уведомить админа об импорте из канала")
 
 # ========= CSV =========
 async def export_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != str(ADMIN_CHAT_ID):
+    if update.effective_user.id != ADMIN_CHAT_ID_INT:
         return
-    path = "catalog_export.csv"
     header = ["id","title","price_rub","photo_file_id","descr","category","brand","sizes","source_chat_id","source_msg_id"]
-    async with aiosqlite.connect(DB_PATH) as db, open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f); writer.writerow(header)
-        async with db.execute("SELECT id,title,price,photo_file_id,descr,category,brand,sizes,source_chat_id,source_msg_id FROM products ORDER BY id DESC") as cur:
-            async for row in cur:
-                row = list(row); row[2] = row[2] / 100
-                writer.writerow(row)
-    await update.message.reply_document(InputFile(path), filename="catalog_export.csv", caption="Экспорт каталога")
-
-async def import_csv_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if str(update.effective_user.id) != str(ADMIN_CHAT_ID):
-        return
-    await update.message.reply_text("Пришлите CSV-файл с колонками: title,price_rub,photo_file_id,descr,category,brand,sizes")
-    return IMPORT_WAIT_FILE
-
-async def import_csv_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.document:
-        await update.message.reply_text("Это не файл. Пришлите CSV-файл или /cancel")
-        return IMPORT_WAIT_FILE
-    file = await update.message.document.get_file()
-    path = await file.download_to_drive(custom_path="import.csv")
-    cnt = 0
-    with open(path, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
+    # файл собирается в памяти и уходит байтами: без общего пути на диске
+    # параллельные /export не перемешивают строки друг друга
+    buf = io.StringIO()
+    writer = csv.writer(buf); writer.writerow(header)
+    async with DB.execute("SELECT id,title,price,photo_file_id,descr,category,brand,sizes,source_chat_id,source_msg_id FROM products ORDER BY id DESC") as cur:
+        async for row in cur:
+            row = list(row); row[2] = f"{row[2] // 100}.{row[2] % 100:02d}"  # копейки без float
+            writer.writerow(row)
+    data = buf.getvalue().encode("utf-8")
+    await update.message.reply_document(data, filename="catalog_export.csv", caption="Экспорт каталога")
+
+def parse_csv_products(data: bytes) -> List[Product]:
+    products = []
+    with io.StringIO(data.decode("utf-8")) as f:
+        for row in csv.DictReader(f):
             try:
                 title = row.get("title") or "Товар"
                 price_rub = row.get("price_rub") or "0"
-                price = int(float(str(price_rub).replace(",", ".")) * 100)
+                price = round(float(str(price_rub).replace(",", ".")) * 100)
                 photo_file_id = row.get("photo_file_id") or None
                 descr = row.get("descr") or ""
                 category = row.get("category") or "Общее"
                 brand = row.get("brand") or "NoBrand"
                 sizes = row.get("sizes") or None
-                p = Product(0, title, price, photo_file_id, descr, category, brand, sizes, None, None)
-                pid = await add_product(p)
-                if pid:
-                    cnt += 1
+                products.append(Product(0, title, price, photo_file_id, descr, category, brand, sizes, None, None))
             except Exception:
                 continue
+    return products
+
+async def import_csv_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_CHAT_ID_INT:
+        return
+    context.user_data["awaiting_import"] = True
+    await update.message.reply_text(
+        "Пришлите CSV-файл с колонками: title,price_rub,photo_file_id,descr,category,brand,sizes\nОтмена — /cancel"
+    )
+
+# Ожидание файла — флаг в user_data, как у обратной связи, без ConversationHandler
+async def import_csv_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.user_data.pop("awaiting_import", False):
+        return
+    file = await update.message.document.get_file()
+    # download_to_drive пишет файл синхронно в loop; берём байты в память
+    data = bytes(await file.download_as_bytearray())
+    # разбор — синхронный csv, уводим в поток, чтобы не стопорить loop
+    products = await asyncio.to_thread(parse_csv_products, data)
+    cnt = 0
+    # коммитим пачками: лок записи отпускается между ними, корзины не ждут весь импорт
+    for i in range(0, len(products), IMPORT_BATCH_SIZE):
+        cnt += await add_products_bulk(products[i:i + IMPORT_BATCH_SIZE])
+    if cnt:
+        # optimize может писать sqlite_stat1 — только под локом записи
+        async with db_write():
+            await DB.execute("PRAGMA optimize")
     await update.message.reply_text(f"Импорт завершён. Добавлено товаров: {cnt}")
-    return ConversationHandler.END
 
 # ========= PAYMENTS =========
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -680,65 +1028,204 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
     if not res:
         return
     order_id, total = res
-    await update.message.reply_text(f"Оплата прошла успешно! Заказ #{order_id} на {price_fmt(total)} оформлен ✅")
-    if ADMIN_CHAT_ID:
-        await context.bot.send_message(int(ADMIN_CHAT_ID), f"Оплачен заказ #{order_id} от @{update.effective_user.username or update.effective_user.id} на сумму {price_fmt(total)}")
+    u = update.effective_user
+    await send_all(
+        update.message.reply_text(f"Оплата прошла успешно! Заказ #{order_id} на {price_fmt(total)} оформлен ✅"),
+        notify_admin(context.bot, f"Оплачен заказ #{order_id} от @{u.username or u.id} на сумму {price_fmt(total)}"),
+    )
+
+# Без платежей накопившиеся за простой апдейты при старте сбрасываются
+# (DROP_PENDING_UPDATES). С платежами сбрасывать нельзя: деньги за successful_payment
+# уже списаны, а платёж, пришедший между разбором очереди и сбросом, пропал бы.
+# Поэтому очередь разбираем сами — платежи проводим, остальное подтверждаем offset'ом.
+# Просроченные pre_checkout_query повторять бессмысленно: на них 10 секунд.
+async def replay_pending_payments(app: Application):
+    await app.bot.delete_webhook()  # иначе getUpdates недоступен; webhook поставит run_webhook_server
+    offset = None
+    while True:
+        updates = await app.bot.get_updates(offset=offset, timeout=0, allowed_updates=[Update.MESSAGE])
+        if not updates:
+            return
+        offset = updates[-1].update_id + 1
+        for u in updates:
+            if u.message and u.message.successful_payment:
+                await replay_payment(app, u)
+
+# Сбой одного платежа не должен ронять запуск бота: пишем в лог и зовём админа
+async def replay_payment(app: Application, update: Update):
+    try:
+        await successful_payment_callback(update, app.context_types.context.from_update(update, app))
+    except Exception:
+        user = update.effective_user
+        sp = update.message.successful_payment
+        log.exception("Не удалось провести отложенный платёж %s от %s", sp.telegram_payment_charge_id, user.id)
+        try:
+            await notify_admin(
+                app.bot,
+                f"⚠️ Не удалось оформить заказ по оплате {sp.telegram_payment_charge_id} "
+                f"от @{user.username or user.id} на сумму {price_fmt(sp.total_amount)}. Проверьте вручную.",
+            )
+        except Exception:
+            log.exception("Не удалось уведомить админа о сбое платежа")
 
 # ========= MAIN =========
-async def main():
+# Ответы Bot API (в т.ч. пачки getUpdates) разбираем orjson. Исходящие параметры PTB
+# сериализует сам при сборке RequestData, до объекта запроса, их не трогаем.
+class OrjsonRequest(HTTPXRequest):
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> Dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # битый UTF-8/JSON — штатный разбор с errors="replace" и TelegramError
+            return HTTPXRequest.parse_json_payload(payload)
+
+async def post_init(app: Application):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE))
+    await init_db()
+    if PAYMENT_PROVIDER_TOKEN:
+        await replay_pending_payments(app)
+    app.bot_data["channel_worker"] = asyncio.create_task(channel_import_worker(app.bot))
+
+async def post_stop(app: Application):
+    # дописываем всё, что осталось в очереди, пока бот ещё может уведомить админа
+    await CHANNEL_QUEUE.put(None)
+    await app.bot_data.pop("channel_worker")
+
+async def post_shutdown(app: Application):
+    await close_db()
+
+# Webhook без Updater: aiohttp принимает POST от Telegram и кладёт апдейт прямо в
+# update_queue. Жизненный цикл повторяет run_webhook: initialize → post_init →
+# setWebhook → start → ... → stop → post_stop → shutdown → post_shutdown.
+async def run_webhook_server(app: Application):
+    url_path = "/" + (WEBHOOK_PATH or BOT_TOKEN).lstrip("/")
+
+    async def on_update(request: web.Request) -> web.Response:
+        # сравнение за постоянное время; байты — compare_digest не принимает не-ASCII str
+        if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET_TOKEN.encode()
+        ):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(orjson.loads(await request.read()), app.bot)
+        except Exception:
+            log.exception("Не удалось разобрать апдейт из webhook")
+            return web.Response(status=400)
+        await app.update_queue.put(update)
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_post(url_path, on_update)
+    runner = web.AppRunner(web_app, access_log=None)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    try:
+        await app.initialize()
+        await post_init(app)
+        await app.bot.set_webhook(
+            WEBHOOK_URL + url_path,
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+        await app.start()
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        print(f"Bot started (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}). Press Ctrl+C to stop.")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if app.running:
+            await app.stop()
+            await post_stop(app)
+        await app.shutdown()
+        await post_shutdown(app)
+
+# Группы хендлеров (PTB обходит их по возрастанию, в каждой срабатывает первый подходящий):
+#   -2  платежи — редкие, но самые дешёвые и однозначные проверки;
+#   -1  посты каналов — отсекаются по типу чата, до личных фильтров не доходят;
+#    0  команды, файл импорта, колбэки, пересланные посты;
+#    1  навигация по тексту — самый общий фильтр, последним.
+# Апдейт обрабатывается в каждой группе, где нашёлся хендлер, поэтому фильтры групп
+# не пересекаются: пересланный текст исключён из навигации (~FORWARDED).
+def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN не задан. Добавь его в переменные окружения.")
-    app: Application = ApplicationBuilder().token(BOT_TOKEN).build()
+    builder = (
+        ApplicationBuilder().token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(256)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=RATE_LIMIT_PER_SEC, overall_time_period=1, max_retries=RATE_LIMIT_RETRIES,
+        ))
+        .request(OrjsonRequest(
+            connection_pool_size=HTTP_POOL_SIZE, pool_timeout=HTTP_POOL_TIMEOUT,
+            connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT, http_version="2",
+        ))
+        .get_updates_request(OrjsonRequest(
+            connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT, http_version="2",
+        ))
+    )
+    if WEBHOOK_URL:
+        # апдейты приносит свой aiohttp-сервер (run_webhook_server), Updater не нужен
+        builder = builder.updater(None)
+    app: Application = builder.build()
 
-    await init_db()
+    # Платежи
+    if PAYMENT_PROVIDER_TOKEN:
+        app.add_handler(PreCheckoutQueryHandler(precheckout_callback, block=False), group=-2)
+        app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback,
+                                       block=False), group=-2)
+
+    # Автоимпорт из каналов
+    app.add_handler(MessageHandler(CHANNEL_MEDIA, on_channel_post, block=False), group=-1)
 
     # Команды
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("export", export_csv))
-    # Импорт CSV через диалог
-    import_conv = ConversationHandler(
-        entry_points=[CommandHandler("import", import_csv_cmd)],
-        states={IMPORT_WAIT_FILE: [MessageHandler(filters.Document.ALL, import_csv_file)]},
-        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
-        allow_reentry=True
-    )
-    app.add_handler(import_conv)
+    app.add_handler(CommandHandler("start", start, block=False))
+    app.add_handler(CommandHandler("export", export_csv, block=False))
+    app.add_handler(CommandHandler("cancel", cancel, filters=filters.ChatType.PRIVATE, block=False))
+    # Импорт CSV: /import ставит флаг, следующий документ в личке — файл импорта
+    app.add_handler(CommandHandler("import", import_csv_cmd, filters=filters.ChatType.PRIVATE, block=False))
+    app.add_handler(MessageHandler(PRIVATE_DOCUMENT, import_csv_file, block=False))
 
     # Колбэки
-    app.add_handler(CallbackQueryHandler(on_cb))
+    app.add_handler(CallbackQueryHandler(on_cb, block=False))
 
     # Импорт из пересланных постов (личка)
-    app.add_handler(MessageHandler(
-        (filters.PHOTO | filters.TEXT) & filters.FORWARDED & filters.ChatType.PRIVATE,
-        import_from_forward
-    ))
+    app.add_handler(MessageHandler(PRIVATE_FORWARD_MEDIA, import_from_forward, block=False))
 
     # Навигация (личка)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, on_text))
-
-    # Автоимпорт из каналов
-    app.add_handler(MessageHandler(
-        (filters.PHOTO | filters.TEXT) & filters.ChatType.CHANNEL,
-        on_channel_post
-    ))
+    app.add_handler(MessageHandler(PRIVATE_TEXT, on_text, block=False), group=1)
 
-    # Платежи
-    if PAYMENT_PROVIDER_TOKEN:
-        app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-        app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-
-    print("Bot started. Press Ctrl+C to stop.")
-    await app.run_polling()
+    # run_polling сам крутит цикл: initialize → post_init → ... → post_shutdown
+    if WEBHOOK_URL:
+        asyncio.get_event_loop().run_until_complete(run_webhook_server(app))
+    else:
+        print("Bot started. Press Ctrl+C to stop.")
+        app.run_polling(timeout=POLL_TIMEOUT, poll_interval=0.0, allowed_updates=ALLOWED_UPDATES,
+                        drop_pending_updates=DROP_PENDING_UPDATES)
 
 if __name__ == "__main__":
-    # Фикс для Python 3.13 на Render: НЕ используем asyncio.run(...)
+    # uvloop — быстрее стандартного loop на сетевом I/O; на Windows его нет, там остаётся asyncio
     try:
-        loop = asyncio.get_event_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(main())
-    except (KeyboardInterrupt, SystemExit):
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
         pass
-    # Важно: НЕ закрываем loop вручную — пусть платформа завершит процесс сама.
+    # Фикс для Python 3.13 на Render: заранее создаём loop, если его нет,
+    # run_polling() и webhook-сервер возьмут его через get_event_loop()
+    try:
+        asyncio.get_event_loop()
+    except RuntimeError:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    main()